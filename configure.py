@@ -2,44 +2,46 @@ from __future__ import print_function
 
 import json
 import sys
+import collections
 import errno
 import optparse
 import os
-import pipes
-import pprint
 import re
 import shlex
 import subprocess
 import shutil
-import string
-from distutils.spawn import find_executable as which
+
+try:
+  from shutil import which  # Python 3.3+
+except ImportError:
+  from distutils.spawn import find_executable as which
 
 # If not run from node/, cd to node/.
 os.chdir(os.path.dirname(__file__) or '.')
 
 original_argv = sys.argv[1:]
 
+# sys.platform with any trailing digits stripped, e.g. 'aix7' -> 'aix' and
+# 'linux2' -> 'linux', but also 'win32' -> 'win' and 'sunos5' -> 'sunos'.
+# Only used to tell platform families apart.
+host_platform = sys.platform.rstrip('0123456789')
+
+# Shared library suffix per host_platform, for the node module version.
+# Everything else uses 'so.%s'.
+shlib_suffix_templates = {
+  'aix'    : '%s.a',
+  'darwin' : '%s.dylib',
+}
+
 # gcc and g++ as defaults matches what GYP's Makefile generator does,
 # except on OS X.
 CC = os.environ.get('CC', 'cc' if sys.platform == 'darwin' else 'gcc')
 CXX = os.environ.get('CXX', 'c++' if sys.platform == 'darwin' else 'g++')
 
-sys.path.insert(0, os.path.join('tools', 'gyp', 'pylib'))
-from gyp.common import GetFlavor
-
 # imports in tools/configure.d
 sys.path.insert(0, os.path.join('tools', 'configure.d'))
 import nodedownload
 
-# imports in tools/
-sys.path.insert(0, 'tools')
-import getmoduleversion
-from gyp_node import run_gyp
-
-# imports in deps/v8/tools/node
-sys.path.insert(0, os.path.join('deps', 'v8', 'tools', 'node'))
-from fetch_deps import FetchDeps
-
 # parse our options
 parser = optparse.OptionParser()
 
@@ -191,131 +193,38 @@ parser.add_option('--experimental-http-parser',
     dest='experimental_http_parser',
     help='(no-op)')
 
-shared_optgroup.add_option('--shared-http-parser',
-    action='store_true',
-    dest='shared_http_parser',
-    help='link to a shared http_parser DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-http-parser-includes',
-    action='store',
-    dest='shared_http_parser_includes',
-    help='directory containing http_parser header files')
-
-shared_optgroup.add_option('--shared-http-parser-libname',
-    action='store',
-    dest='shared_http_parser_libname',
-    default='http_parser',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-http-parser-libpath',
-    action='store',
-    dest='shared_http_parser_libpath',
-    help='a directory to search for the shared http_parser DLL')
-
-shared_optgroup.add_option('--shared-libuv',
-    action='store_true',
-    dest='shared_libuv',
-    help='link to a shared libuv DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-libuv-includes',
-    action='store',
-    dest='shared_libuv_includes',
-    help='directory containing libuv header files')
-
-shared_optgroup.add_option('--shared-libuv-libname',
-    action='store',
-    dest='shared_libuv_libname',
-    default='uv',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-libuv-libpath',
-    action='store',
-    dest='shared_libuv_libpath',
-    help='a directory to search for the shared libuv DLL')
-
-shared_optgroup.add_option('--shared-nghttp2',
-    action='store_true',
-    dest='shared_nghttp2',
-    help='link to a shared nghttp2 DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-nghttp2-includes',
-    action='store',
-    dest='shared_nghttp2_includes',
-    help='directory containing nghttp2 header files')
-
-shared_optgroup.add_option('--shared-nghttp2-libname',
-    action='store',
-    dest='shared_nghttp2_libname',
-    default='nghttp2',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-nghttp2-libpath',
-    action='store',
-    dest='shared_nghttp2_libpath',
-    help='a directory to search for the shared nghttp2 DLLs')
-
-shared_optgroup.add_option('--shared-openssl',
-    action='store_true',
-    dest='shared_openssl',
-    help='link to a shared OpenSSl DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-openssl-includes',
-    action='store',
-    dest='shared_openssl_includes',
-    help='directory containing OpenSSL header files')
-
-shared_optgroup.add_option('--shared-openssl-libname',
-    action='store',
-    dest='shared_openssl_libname',
-    default='crypto,ssl',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-openssl-libpath',
-    action='store',
-    dest='shared_openssl_libpath',
-    help='a directory to search for the shared OpenSSL DLLs')
-
-shared_optgroup.add_option('--shared-zlib',
-    action='store_true',
-    dest='shared_zlib',
-    help='link to a shared zlib DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-zlib-includes',
-    action='store',
-    dest='shared_zlib_includes',
-    help='directory containing zlib header files')
-
-shared_optgroup.add_option('--shared-zlib-libname',
-    action='store',
-    dest='shared_zlib_libname',
-    default='z',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-zlib-libpath',
-    action='store',
-    dest='shared_zlib_libpath',
-    help='a directory to search for the shared zlib DLL')
-
-shared_optgroup.add_option('--shared-cares',
-    action='store_true',
-    dest='shared_libcares',
-    help='link to a shared cares DLL instead of static linking')
-
-shared_optgroup.add_option('--shared-cares-includes',
-    action='store',
-    dest='shared_libcares_includes',
-    help='directory containing cares header files')
-
-shared_optgroup.add_option('--shared-cares-libname',
-    action='store',
-    dest='shared_libcares_libname',
-    default='cares',
-    help='alternative lib name to link to [default: %default]')
-
-shared_optgroup.add_option('--shared-cares-libpath',
-    action='store',
-    dest='shared_libcares_libpath',
-    help='a directory to search for the shared cares DLL')
+# (option name, dest name, name used in the help text, default libname,
+#  what --shared-*-libpath searches for)
+shared_libs = (
+  ('http-parser', 'http_parser', 'http_parser', 'http_parser', 'DLL'),
+  ('libuv', 'libuv', 'libuv', 'uv', 'DLL'),
+  ('nghttp2', 'nghttp2', 'nghttp2', 'nghttp2', 'DLLs'),
+  ('openssl', 'openssl', 'OpenSSL', 'crypto,ssl', 'DLLs'),
+  ('zlib', 'zlib', 'zlib', 'z', 'DLL'),
+  ('cares', 'libcares', 'cares', 'cares', 'DLL'),
+)
+
+for (name, lib, desc, libname, dlls) in shared_libs:
+  shared_optgroup.add_option('--shared-%s' % name,
+      action='store_true',
+      dest='shared_%s' % lib,
+      help='link to a shared %s DLL instead of static linking' % desc)
+
+  shared_optgroup.add_option('--shared-%s-includes' % name,
+      action='store',
+      dest='shared_%s_includes' % lib,
+      help='directory containing %s header files' % desc)
+
+  shared_optgroup.add_option('--shared-%s-libname' % name,
+      action='store',
+      dest='shared_%s_libname' % lib,
+      default=libname,
+      help='alternative lib name to link to [default: %default]')
+
+  shared_optgroup.add_option('--shared-%s-libpath' % name,
+      action='store',
+      dest='shared_%s_libpath' % lib,
+      help='a directory to search for the shared %s %s' % (desc, dlls))
 
 parser.add_option_group(shared_optgroup)
 
@@ -568,6 +477,12 @@ parser.add_option('--v8-non-optimized-debug',
     default=False,
     help='compile V8 with minimal optimizations and with runtime checks')
 
+parser.add_option('--config-cache',
+    action='store_true',
+    dest='config_cache',
+    help='reuse the results of the previous --config-cache run when the '
+         'options, environment and inputs have not changed')
+
 # Create compile_commands.json in out/Debug and out/Release.
 parser.add_option('-C',
     action='store_true',
@@ -582,6 +497,20 @@ options.prefix = os.path.expanduser(options.prefix or '')
 # set up auto-download list
 auto_downloads = nodedownload.parse(options.download_list)
 
+# The remaining imports pull in gyp, which is only needed once the options
+# are known to be valid, so `./configure --help` doesn't pay for it.
+sys.path.insert(0, os.path.join('tools', 'gyp', 'pylib'))
+from gyp.common import GetFlavor
+
+# imports in tools/
+sys.path.insert(0, 'tools')
+import getmoduleversion
+from gyp_node import run_gyp
+
+# imports in deps/v8/tools/node
+sys.path.insert(0, os.path.join('deps', 'v8', 'tools', 'node'))
+from fetch_deps import FetchDeps
+
 
 def error(msg):
   prefix = '\033[1m\033[31mERROR\033[0m' if os.isatty(1) else 'ERROR'
@@ -590,11 +519,14 @@ def error(msg):
 
 def warn(msg):
   warn.warned = True
+  warn.messages.append(msg)
   prefix = '\033[1m\033[93mWARNING\033[0m' if os.isatty(1) else 'WARNING'
   print('%s: %s' % (prefix, msg))
 
 # track if warnings occurred
 warn.warned = False
+# and which, so --config-cache can repeat them
+warn.messages = []
 
 def info(msg):
   prefix = '\033[1m\033[32mINFO\033[0m' if os.isatty(1) else 'INFO'
@@ -606,6 +538,7 @@ def print_verbose(x):
   if type(x) is str:
     print(x)
   else:
+    import pprint
     pprint.pprint(x, indent=2)
 
 def b(value):
@@ -623,42 +556,283 @@ def B(value):
     return 0
 
 
+def memoize(fn):
+  """Caches the return value of fn for each distinct argument tuple."""
+  cache = {}
+  def memoized(*args):
+    if args not in cache:
+      cache[args] = fn(*args)
+    return cache[args]
+  return memoized
+
+# The same few executables are looked up repeatedly; walk PATH once for each.
+which = memoize(which)
+
+
+# Results of expensive probes (compiler invocations and the like) are kept
+# here between configure runs. `make distclean` wipes it along with out/.
+configure_cache_dir = os.path.join('out', '.configure_cache')
+
+@memoize
+def list_configure_cache():
+  """Returns the names of the files in the cache directory, so that missing
+  caches are skipped without trying to open each of them."""
+  try:
+    return frozenset(os.listdir(configure_cache_dir))
+  except OSError:
+    return frozenset()
+
+
+@memoize
+def read_configure_cache(name):
+  """Returns the dict stored under name by a previous configure run.
+  The same dict is returned on every call, so callers can update it in place
+  and persist it again with write_configure_cache()."""
+  if name not in list_configure_cache():
+    return {}
+  try:
+    with open(os.path.join(configure_cache_dir, name)) as f:
+      return to_native_str(json.load(f))
+  except (IOError, ValueError):
+    return {}
+
+
+def to_native_str(data):
+  """Converts the unicode strings json.load() returns on Python 2 back into
+  str, so cached values look the same as freshly computed ones."""
+  if isinstance(data, dict):
+    return dict((to_native_str(k), to_native_str(v))
+                for (k, v) in data.items())
+  if isinstance(data, list):
+    return [to_native_str(v) for v in data]
+  if not isinstance(data, (str, int, float, bool, type(None))):
+    return data.encode('utf-8')
+  return data
+
+
+def write_configure_cache(name):
+  """Atomically persists the dict returned by read_configure_cache(name)."""
+  filename = os.path.join(configure_cache_dir, name)
+  try:
+    try:
+      os.makedirs(configure_cache_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST: raise e
+    with open(filename + '.tmp', 'w') as f:
+      json.dump(read_configure_cache(name), f)
+    if sys.platform == 'win32' and os.path.exists(filename):
+      os.remove(filename)  # os.rename() does not overwrite on Windows.
+    os.rename(filename + '.tmp', filename)
+  except (IOError, OSError) as e:
+    print_verbose('could not write %s: %s' % (filename, e))
+
+
+def file_stamp(path):
+  """Returns the absolute path, mtime and size of path, or None if it doesn't
+  exist."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return [os.path.abspath(path), st.st_mtime, st.st_size]
+
+
+def command_stamp(cmd):
+  """Returns the file_stamp() of every executable named in the command cmd,
+  or None if it doesn't name one."""
+  stamp = []
+  for arg in shlex.split(cmd):
+    path = which(arg)
+    if path:
+      stamp.append(file_stamp(path))
+  return stamp or None
+
+
+# Environment variables that change what pkg-config reports.
+pkg_config_env = ('PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR',
+                  'PKG_CONFIG_SYSROOT_DIR', 'PKG_CONFIG_ALLOW_SYSTEM_CFLAGS',
+                  'PKG_CONFIG_ALLOW_SYSTEM_LIBS')
+
+# The .pc files pkg_config() read, and their directories.
+pkg_config_files = []
+
+def spawn_pkg_config(pkg_config, args):
+  return subprocess.Popen(shlex.split(pkg_config) + ['--silence-errors'] + args,
+                          stdout=subprocess.PIPE)
+
+def read_pc_files(pkg_config, pkg):
+  """Returns the .pc file of pkg and of every package it requires, directly
+  or not, each preceded by its directory."""
+  files = []
+  seen = set()
+  pkgs = [pkg]
+  while pkgs:
+    # Query a whole level of the dependency tree at once.
+    procs = [(name,
+              spawn_pkg_config(pkg_config, ['--variable=pcfiledir', name]),
+              spawn_pkg_config(pkg_config, ['--print-requires',
+                                            '--print-requires-private', name]))
+             for name in pkgs]
+    seen.update(pkgs)
+    pkgs = []
+    for (name, pcfiledir_proc, requires_proc) in procs:
+      pcfiledir = pcfiledir_proc.communicate()[0].strip()
+      if pcfiledir:
+        files += [pcfiledir, os.path.join(pcfiledir, name + '.pc')]
+      # Lines look like "foo >= 1.0"; only the package name matters.
+      for line in requires_proc.communicate()[0].splitlines():
+        required = line.split()[:1]
+        if required and required[0] not in seen and required[0] not in pkgs:
+          pkgs += required
+  return files
+
+@memoize
 def pkg_config(pkg):
   """Run pkg-config on the specified package
   Returns ("-l flags", "-I flags", "-L flags", "version")
   otherwise (None, None, None, None)"""
   pkg_config = os.environ.get('PKG_CONFIG', 'pkg-config')
-  retval = ()
-  for flag in ['--libs-only-l', '--cflags-only-I',
-               '--libs-only-L', '--modversion']:
-    try:
-      proc = subprocess.Popen(
-          shlex.split(pkg_config) + ['--silence-errors', flag, pkg],
-          stdout=subprocess.PIPE)
-      val = proc.communicate()[0].strip()
-    except OSError as e:
-      if e.errno != errno.ENOENT: raise e  # Unexpected error.
-      return (None, None, None, None)  # No pkg-config/pkgconf installed.
-    retval += (val,)
-  return retval
-
 
-def try_check_compiler(cc, lang):
+  # With --config-cache, a cached result stays good for as long as pkg-config,
+  # its environment and the .pc files of the package and everything it
+  # requires stay the same. The directories' mtimes catch .pc files that are
+  # added or removed.
+  cache = read_configure_cache('pkg_config.json') \
+          if options.config_cache else {}
+  def stamp(pc_files):
+    return [[pkg_config] + [os.environ.get(var, '') for var in pkg_config_env],
+            command_stamp(pkg_config)] + \
+           [file_stamp(path) for path in pc_files]
+  entry = cache.get(pkg, {})
+  if 'pc_files' in entry and entry['stamp'] == stamp(entry['pc_files']):
+    pkg_config_files.extend(entry['pc_files'])
+    return tuple(entry['values'])
+
+  # Spawn all queries before reading any of them so they run concurrently
+  # instead of paying for sequential fork/exec round trips.
+  try:
+    procs = [spawn_pkg_config(pkg_config, [flag, pkg]) for flag in
+             ['--libs-only-l', '--cflags-only-I', '--libs-only-L',
+              '--modversion']]
+  except OSError as e:
+    if e.errno != errno.ENOENT: raise e  # Unexpected error.
+    return (None, None, None, None)  # No pkg-config/pkgconf installed.
+  # Only --config-cache needs to know which files the results came from.
+  pc_files = read_pc_files(pkg_config, pkg) if options.config_cache else []
+  values = [proc.communicate()[0].strip() for proc in procs]
+
+  pkg_config_files.extend(pc_files)
+  if pc_files:
+    cache[pkg] = { 'pc_files': pc_files, 'stamp': stamp(pc_files),
+                   'values': values }
+    write_configure_cache('pkg_config.json')
+  return tuple(values)
+
+
+def compiler_identity(cc):
+  """Returns the device and inode of the executable the compiler command cc
+  runs, together with the name it is invoked as and its extra arguments, or
+  None if it can't be found. The name matters because wrappers such as
+  ccache, busybox-style multiplexers and the xcrun shims pick the real
+  compiler from argv[0]."""
+  argv = shlex.split(cc)
+  path = argv and which(argv[0])
+  if not path:
+    return None
+  st = os.stat(path)
+  return (st.st_dev, st.st_ino, os.path.basename(argv[0]), tuple(argv[1:]))
+
+
+# (cc, lang) -> result of checking that compiler, see try_check_compilers().
+compiler_checks = {}
+
+def try_check_compilers(*compilers):
+  """Checks the version of each (cc, lang) pair. The compilers are run
+  concurrently, and only the first time they are asked about; with
+  --config-cache, results for unchanged compiler binaries are reused from
+  earlier configure runs. Returns a list of (ok, is_clang, clang_version,
+  gcc_version) tuples in the same order."""
+  # The stamps can't see through wrappers such as ccache or the xcrun shims,
+  # which pick the real compiler at run time, so only reuse checks on request.
+  cache = read_configure_cache('compiler_checks.json') \
+          if options.config_cache else {}
+  procs = {}
+  probed = {}  # compiler_identity() -> the compiler probed for it
+  aliases = {}  # compiler -> the compiler with the same identity
+  stamps = {}
+  for compiler in compilers:
+    if compiler in compiler_checks or compiler in procs:
+      continue
+    (cc, lang) = compiler
+    key = '%s %s' % (lang, cc)
+    stamps[compiler] = command_stamp(cc)
+    if stamps[compiler] and key in cache and \
+       cache[key]['stamp'] == stamps[compiler]:
+      (ok, is_clang, clang_version, gcc_version) = cache[key]['check']
+      compiler_checks[compiler] = (ok, is_clang,
+                                   clang_version and tuple(clang_version),
+                                   tuple(gcc_version))
+      continue
+    identity = compiler_identity(cc)
+    if identity in probed:
+      aliases[compiler] = probed[identity]
+      continue
+    if identity:
+      probed[identity] = compiler
+    try:
+      proc = subprocess.Popen(shlex.split(cc) + ['-E', '-P', '-x', lang, '-'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+      procs[compiler] = None
+      continue
+    try:
+      proc.stdin.write('__clang__ __GNUC__ __GNUC_MINOR__ __GNUC_PATCHLEVEL__ '
+                       '__clang_major__ __clang_minor__ __clang_patchlevel__')
+    except (IOError, OSError) as e:
+      if e.errno != errno.EPIPE: raise e  # Otherwise the compiler exited early.
+    procs[compiler] = proc
+
+  for (compiler, proc) in procs.items():
+    if proc is None:
+      compiler_checks[compiler] = (False, False, '', '')
+      continue
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+      # Don't mistake a failed run for a compiler that predefines nothing.
+      compiler_checks[compiler] = (False, False, '', '')
+      continue
+    values = (out.split() + ['0'] * 7)[0:7]
+    is_clang = values[0] == '1'
+    gcc_version = tuple(map(int, values[1:1+3]))
+    clang_version = tuple(map(int, values[4:4+3])) if is_clang else None
+    compiler_checks[compiler] = (True, is_clang, clang_version, gcc_version)
+  for (compiler, alias) in aliases.items():
+    compiler_checks[compiler] = compiler_checks[alias]
+
+  checked = [compiler for compiler in list(procs) + list(aliases)
+             if compiler_checks[compiler][0] and stamps[compiler]]
+  for compiler in checked:
+    cache['%s %s' % (compiler[1], compiler[0])] = {
+      'stamp': stamps[compiler], 'check': compiler_checks[compiler] }
+  if checked and options.config_cache:
+    write_configure_cache('compiler_checks.json')
+
+  return [compiler_checks[compiler] for compiler in compilers]
+
+
+def spawn_compiler(cc, args, env=None):
+  """Starts the compiler command cc with args and all standard streams piped.
+  Exits with an error if the compiler can't be run."""
   try:
-    proc = subprocess.Popen(shlex.split(cc) + ['-E', '-P', '-x', lang, '-'],
-                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return subprocess.Popen(shlex.split(cc) + args, stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                            env=env)
   except OSError:
-    return (False, False, '', '')
-
-  proc.stdin.write('__clang__ __GNUC__ __GNUC_MINOR__ __GNUC_PATCHLEVEL__ '
-                   '__clang_major__ __clang_minor__ __clang_patchlevel__')
-
-  values = (proc.communicate()[0].split() + ['0'] * 7)[0:7]
-  is_clang = values[0] == '1'
-  gcc_version = tuple(map(int, values[1:1+3]))
-  clang_version = tuple(map(int, values[4:4+3])) if is_clang else None
+    error('''No acceptable C compiler found!
 
-  return (True, is_clang, clang_version, gcc_version)
+       Please make sure you have a C compiler installed on your system and/or
+       consider adjusting the CC environment variable if you installed
+       it in a non-standard prefix.''')
 
 
 #
@@ -667,18 +841,33 @@ def try_check_compiler(cc, lang):
 # Commands and regular expressions to obtain its version number are taken from
 # https://github.com/openssl/openssl/blob/OpenSSL_1_0_2-stable/crypto/sha/asm/sha512-x86_64.pl#L112-L129
 #
-def get_version_helper(cc, regexp):
-  try:
-    proc = subprocess.Popen(shlex.split(cc) + ['-v'], stdin=subprocess.PIPE,
-                            stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-  except OSError:
-    error('''No acceptable C compiler found!
-
-       Please make sure you have a C compiler installed on your system and/or
-       consider adjusting the CC environment variable if you installed
-       it in a non-standard prefix.''')
+nasm_version_regex = re.compile(r"NASM version ([2-9]\.[0-9][0-9]+)")
+gas_version_regex = re.compile(r"GNU assembler version ([2-9]\.[0-9]+)")
+llvm_version_regex = re.compile(
+    r"(^(?:FreeBSD )?clang version|based on LLVM) ([3-9]\.[0-9]+)")
+xcode_version_regex = re.compile(r"(^Apple LLVM version) ([0-9]+\.[0-9]+)")
+
+@memoize
+def get_version_banner(cc):
+  """Returns the version banner the compiler command cc prints for -v."""
+  return spawn_compiler(cc, ['-v']).communicate()[1]
+
+def read_first_line(proc, stream):
+  """Returns the first line proc writes to stream (its stdout or stderr),
+  then stops proc instead of waiting for the rest of its output."""
+  line = stream.readline()
+  for f in (proc.stdin, proc.stdout, proc.stderr):
+    if f: f.close()
+  if proc.poll() is None:
+    try:
+      proc.kill()
+    except OSError:
+      pass  # It exited in the meantime.
+  proc.wait()
+  return line
 
-  match = re.search(regexp, proc.communicate()[1])
+def get_version_helper(cc, regexp):
+  match = regexp.search(get_version_banner(cc))
 
   if match:
     return match.group(2)
@@ -696,8 +885,7 @@ def get_nasm_version(asm):
          and refer BUILDING.md.''')
     return '0'
 
-  match = re.match(r"NASM version ([2-9]\.[0-9][0-9]+)",
-                   proc.communicate()[0])
+  match = nasm_version_regex.match(read_first_line(proc, proc.stdout))
 
   if match:
     return match.group(1)
@@ -705,31 +893,18 @@ def get_nasm_version(asm):
     return '0'
 
 def get_llvm_version(cc):
-  return get_version_helper(
-    cc, r"(^(?:FreeBSD )?clang version|based on LLVM) ([3-9]\.[0-9]+)")
+  return get_version_helper(cc, llvm_version_regex)
 
 def get_xcode_version(cc):
-  return get_version_helper(
-    cc, r"(^Apple LLVM version) ([0-9]+\.[0-9]+)")
+  return get_version_helper(cc, xcode_version_regex)
 
 def get_gas_version(cc):
-  try:
-    custom_env = os.environ.copy()
-    custom_env["LC_ALL"] = "C"
-    proc = subprocess.Popen(shlex.split(cc) + ['-Wa,-v', '-c', '-o',
-                                               '/dev/null', '-x',
-                                               'assembler',  '/dev/null'],
-                            stdin=subprocess.PIPE, stderr=subprocess.PIPE,
-                            stdout=subprocess.PIPE, env=custom_env)
-  except OSError:
-    error('''No acceptable C compiler found!
-
-       Please make sure you have a C compiler installed on your system and/or
-       consider adjusting the CC environment variable if you installed
-       it in a non-standard prefix.''')
-
-  gas_ret = proc.communicate()[1]
-  match = re.match(r"GNU assembler version ([2-9]\.[0-9]+)", gas_ret)
+  custom_env = os.environ.copy()
+  custom_env["LC_ALL"] = "C"
+  proc = spawn_compiler(cc, ['-Wa,-v', '-c', '-o', '/dev/null',
+                             '-x', 'assembler', '/dev/null'], custom_env)
+  gas_ret = read_first_line(proc, proc.stderr)
+  match = gas_version_regex.match(gas_ret)
 
   if match:
     return match.group(1)
@@ -750,13 +925,15 @@ def check_compiler(o):
         o['variables']['openssl_no_asm'] = 1
     return
 
-  ok, is_clang, clang_version, gcc_version = try_check_compiler(CXX, 'c++')
+  (cxx_check, cc_check) = try_check_compilers((CXX, 'c++'), (CC, 'c'))
+
+  ok, is_clang, clang_version, gcc_version = cxx_check
   if not ok:
     warn('failed to autodetect C++ compiler version (CXX=%s)' % CXX)
   elif clang_version < (8, 0, 0) if is_clang else gcc_version < (6, 3, 0):
     warn('C++ compiler too old, need g++ 6.3.0 or clang++ 8.0.0 (CXX=%s)' % CXX)
 
-  ok, is_clang, clang_version, gcc_version = try_check_compiler(CC, 'c')
+  ok, is_clang, clang_version, gcc_version = cc_check
   if not ok:
     warn('failed to autodetect C compiler version (CC=%s)' % CC)
   elif not is_clang and gcc_version < (4, 2, 0):
@@ -778,88 +955,94 @@ def check_compiler(o):
     o['variables']['gas_version'] = get_gas_version(CC)
 
 
-def cc_macros(cc=None):
-  """Checks predefined macros using the C compiler command."""
+macro_regex = re.compile(r'^#define[ \t]+(\S+)[ \t]+(\S.*)$', re.MULTILINE)
 
-  try:
-    p = subprocess.Popen(shlex.split(cc or CC) + ['-dM', '-E', '-'],
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-  except OSError:
-    error('''No acceptable C compiler found!
-
-       Please make sure you have a C compiler installed on your system and/or
-       consider adjusting the CC environment variable if you installed
-       it in a non-standard prefix.''')
+# The predefined macros that configure actually looks at. cc_macros() drops
+# the rest of the compiler's ~400 defines, so add to this list before testing
+# for a new one.
+wanted_macros = frozenset((
+  '__aarch64__', '__arm__', '__ARM_ARCH', '__ARM_PCS_VFP', '__i386__',
+  '__PPC__', '__PPC64__', '__s390__', '__s390x__', '__x86_64__',
+))
 
-  p.stdin.write('\n')
-  out = p.communicate()[0]
+@memoize
+def cc_macros(cc=None):
+  """Checks predefined macros using the C compiler command."""
 
-  out = str(out).split('\n')
+  cc = cc or CC
+  # Like the compiler checks, only reuse results when --config-cache asks
+  # for it: the stamps can't see through wrappers such as ccache or xcrun.
+  cache = read_configure_cache('cc_macros.json') \
+          if options.config_cache else {}
+  # A cached entry is only good for the same compiler binaries and the same
+  # set of wanted macros.
+  stamp = command_stamp(cc)
+  if stamp:
+    stamp = stamp + [sorted(wanted_macros)]
+  if stamp and cc in cache and cache[cc]['stamp'] == stamp:
+    return cache[cc]['macros']
+
+  proc = spawn_compiler(cc, ['-dM', '-E', '-'])
+  (out, err) = proc.communicate('\n')
+  if proc.returncode != 0:
+    # Don't parse, let alone cache, the output of a failed run.
+    warn('could not check predefined macros (CC=%s):\n%s' % (cc, err.strip()))
+    return {}
 
   k = {}
-  for line in out:
-    lst = shlex.split(line)
-    if len(lst) > 2:
-      key = lst[1]
-      val = lst[2]
-      k[key] = val
+  for (key, val) in macro_regex.findall(out):
+    if key not in wanted_macros:
+      continue
+    # Values are normally a single token; let shlex unquote string literals.
+    k[key] = shlex.split(val)[0] if val[0] in '"\'' else val.split()[0]
+
+  if stamp and options.config_cache:
+    cache[cc] = { 'stamp': stamp, 'macros': k }
+    write_configure_cache('cc_macros.json')
   return k
 
 
-def is_arch_armv7():
-  """Check for ARMv7 instructions"""
-  cc_macros_cache = cc_macros()
-  return cc_macros_cache.get('__ARM_ARCH') == '7'
-
-
-def is_arch_armv6():
-  """Check for ARMv6 instructions"""
-  cc_macros_cache = cc_macros()
-  return cc_macros_cache.get('__ARM_ARCH') == '6'
-
+ArmInfo = collections.namedtuple('ArmInfo', ['arch', 'hard_float_vfp'])
 
-def is_arm_hard_float_abi():
-  """Check for hardfloat or softfloat eabi on ARM"""
+def arm_probe(cc=None):
+  """Check for the ARM instruction set version and hardfloat or softfloat
+  eabi"""
+  k = cc_macros(cc)
   # GCC versions 4.6 and above define __ARM_PCS or __ARM_PCS_VFP to specify
   # the Floating Point ABI used (PCS stands for Procedure Call Standard).
   # We use these as well as a couple of other defines to statically determine
   # what FP ABI used.
-
-  return '__ARM_PCS_VFP' in cc_macros()
+  return ArmInfo(k.get('__ARM_ARCH'), '__ARM_PCS_VFP' in k)
 
 
 def host_arch_cc():
   """Host architecture check using the CC command."""
 
-  if sys.platform.startswith('aix'):
+  if host_platform == 'aix':
     # we only support gcc at this point and the default on AIX
     # would be xlc so hard code gcc
     k = cc_macros('gcc')
   else:
     k = cc_macros(os.environ.get('CC_host'))
 
-  matchup = {
-    '__aarch64__' : 'arm64',
-    '__arm__'     : 'arm',
-    '__i386__'    : 'ia32',
-    '__PPC64__'   : 'ppc64',
-    '__PPC__'     : 'ppc64',
-    '__x86_64__'  : 'x64',
-    '__s390__'    : 's390',
-    '__s390x__'   : 's390x',
-  }
+  # The first macro that is defined wins. s390x compilers define __s390__ as
+  # well, so __s390x__ has to be checked before it.
+  matchup = (
+    ('__x86_64__'  , 'x64'),
+    ('__aarch64__' , 'arm64'),
+    ('__arm__'     , 'arm'),
+    ('__i386__'    , 'ia32'),
+    ('__PPC64__'   , 'ppc64'),
+    ('__PPC__'     , 'ppc64'),
+    ('__s390x__'   , 's390x'),
+    ('__s390__'    , 's390'),
+  )
 
-  rtn = 'ia32' # default
+  for (macro, arch) in matchup:
+    if k.get(macro, '0') != '0':
+      return arch
 
-  for i in matchup:
-    if i in k and k[i] != '0':
-      rtn = matchup[i]
-      if rtn != 's390':
-        break
-
-  return rtn
+  return 'ia32' # default
 
 
 def host_arch_win():
@@ -878,20 +1061,22 @@ def host_arch_win():
 
 
 def configure_arm(o):
+  arm = arm_probe()
+
   if options.arm_float_abi:
     arm_float_abi = options.arm_float_abi
-  elif is_arm_hard_float_abi():
+  elif arm.hard_float_vfp:
     arm_float_abi = 'hard'
   else:
     arm_float_abi = 'default'
 
   arm_fpu = 'vfp'
 
-  if is_arch_armv7():
+  if arm.arch == '7':
     arm_fpu = 'vfpv3'
     o['variables']['arm_version'] = '7'
   else:
-    o['variables']['arm_version'] = '6' if is_arch_armv6() else 'default'
+    o['variables']['arm_version'] = '6' if arm.arch == '6' else 'default'
 
   o['variables']['arm_thumb'] = 0      # -marm
   o['variables']['arm_float_abi'] = arm_float_abi
@@ -904,20 +1089,20 @@ def configure_arm(o):
 
 
 def gcc_version_ge(version_checked):
-  for compiler in [(CC, 'c'), (CXX, 'c++')]:
-    ok, is_clang, clang_version, compiler_version = \
-      try_check_compiler(compiler[0], compiler[1])
+  for (ok, is_clang, clang_version, compiler_version) in \
+      try_check_compilers((CC, 'c'), (CXX, 'c++')):
     if is_clang or compiler_version < version_checked:
       return False
   return True
 
 
 def configure_node(o):
+  variables = o['variables']
   if options.dest_os == 'android':
-    o['variables']['OS'] = 'android'
-  o['variables']['node_prefix'] = options.prefix
-  o['variables']['node_install_npm'] = b(not options.without_npm)
-  o['variables']['node_report'] = b(not options.without_report)
+    variables['OS'] = 'android'
+  variables['node_prefix'] = options.prefix
+  variables['node_install_npm'] = b(not options.without_npm)
+  variables['node_report'] = b(not options.without_report)
   o['default_configuration'] = 'Debug' if options.debug else 'Release'
 
   host_arch = host_arch_win() if os.name == 'nt' else host_arch_cc()
@@ -929,38 +1114,38 @@ def configure_node(o):
   # x86_64 is common across linuxes, allow it as an alias for x64
   if target_arch == 'x86_64':
     target_arch = 'x64'
-  o['variables']['host_arch'] = host_arch
-  o['variables']['target_arch'] = target_arch
-  o['variables']['node_byteorder'] = sys.byteorder
+  variables['host_arch'] = host_arch
+  variables['target_arch'] = target_arch
+  variables['node_byteorder'] = sys.byteorder
 
   cross_compiling = (options.cross_compiling
                      if options.cross_compiling is not None
                      else target_arch != host_arch)
   want_snapshots = not options.without_snapshot
-  o['variables']['want_separate_host_toolset'] = int(
+  variables['want_separate_host_toolset'] = int(
       cross_compiling and want_snapshots)
 
   if options.with_node_snapshot:
-    o['variables']['node_use_node_snapshot'] = 'true'
+    variables['node_use_node_snapshot'] = 'true'
   else:
     # Default to false for now.
     # TODO(joyeecheung): enable it once we fix the hashseed uniqueness
-    o['variables']['node_use_node_snapshot'] = 'false'
+    variables['node_use_node_snapshot'] = 'false'
 
   if target_arch == 'arm':
     configure_arm(o)
 
   if flavor == 'aix':
-    o['variables']['node_target_type'] = 'static_library'
+    variables['node_target_type'] = 'static_library'
 
   if target_arch in ('x86', 'x64', 'ia32', 'x32'):
-    o['variables']['node_enable_v8_vtunejit'] = b(options.enable_vtune_profiling)
+    variables['node_enable_v8_vtunejit'] = b(options.enable_vtune_profiling)
   elif options.enable_vtune_profiling:
     raise Exception(
        'The VTune profiler for JavaScript is only supported on x32, x86, and x64 '
        'architectures.')
   else:
-    o['variables']['node_enable_v8_vtunejit'] = 'false'
+    variables['node_enable_v8_vtunejit'] = 'false'
 
   if flavor != 'linux' and (options.enable_pgo_generate or options.enable_pgo_use):
     raise Exception(
@@ -982,8 +1167,8 @@ def configure_node(o):
         '--enable-pgo-generate first, profile node, and then recompile '
         'with --enable-pgo-use')
 
-  o['variables']['enable_pgo_generate'] = b(options.enable_pgo_generate)
-  o['variables']['enable_pgo_use']      = b(options.enable_pgo_use)
+  variables['enable_pgo_generate'] = b(options.enable_pgo_generate)
+  variables['enable_pgo_use']      = b(options.enable_pgo_use)
 
   if flavor != 'linux' and (options.enable_lto):
     raise Exception(
@@ -998,7 +1183,7 @@ def configure_node(o):
           'The option --enable-lto is supported for gcc and gxx %s'
           ' or newer only.' % (version_checked_str))
 
-  o['variables']['enable_lto'] = b(options.enable_lto)
+  variables['enable_lto'] = b(options.enable_lto)
 
   if flavor in ('solaris', 'mac', 'linux', 'freebsd'):
     use_dtrace = not options.without_dtrace
@@ -1009,12 +1194,12 @@ def configure_node(o):
     if flavor == 'linux':
       if options.systemtap_includes:
         o['include_dirs'] += [options.systemtap_includes]
-    o['variables']['node_use_dtrace'] = b(use_dtrace)
+    variables['node_use_dtrace'] = b(use_dtrace)
   elif options.with_dtrace:
     raise Exception(
        'DTrace is currently only supported on SunOS, MacOS or Linux systems.')
   else:
-    o['variables']['node_use_dtrace'] = 'false'
+    variables['node_use_dtrace'] = 'false'
 
   if options.node_use_large_pages and flavor != 'linux':
     raise Exception(
@@ -1029,131 +1214,134 @@ def configure_node(o):
     # Example full version string: 2.6.32-696.28.1.el6.x86_64
     FULL_KERNEL_VERSION=os.uname()[2]
     KERNEL_VERSION=FULL_KERNEL_VERSION.split('-')[0]
-    if KERNEL_VERSION < "2.6.38":
+    # Compare numerically; as strings, "2.6.9" would sort after "2.6.38".
+    if tuple(map(int, re.findall(r'\d+', KERNEL_VERSION)[:3])) < (2, 6, 38):
       raise Exception(
         'Large pages need Linux kernel version >= 2.6.38')
-  o['variables']['node_use_large_pages'] = b(options.node_use_large_pages)
+  variables['node_use_large_pages'] = b(options.node_use_large_pages)
 
   if options.no_ifaddrs:
     o['defines'] += ['SUNOS_NO_IFADDRS']
 
   # By default, enable ETW on Windows.
   if flavor == 'win':
-    o['variables']['node_use_etw'] = b(not options.without_etw)
+    variables['node_use_etw'] = b(not options.without_etw)
   elif options.with_etw:
     raise Exception('ETW is only supported on Windows.')
   else:
-    o['variables']['node_use_etw'] = 'false'
+    variables['node_use_etw'] = 'false'
 
-  o['variables']['node_with_ltcg'] = b(options.with_ltcg)
+  variables['node_with_ltcg'] = b(options.with_ltcg)
   if flavor != 'win' and options.with_ltcg:
     raise Exception('Link Time Code Generation is only supported on Windows.')
 
   if options.tag:
-    o['variables']['node_tag'] = '-' + options.tag
+    variables['node_tag'] = '-' + options.tag
   else:
-    o['variables']['node_tag'] = ''
+    variables['node_tag'] = ''
 
-  o['variables']['node_release_urlbase'] = options.release_urlbase or ''
+  variables['node_release_urlbase'] = options.release_urlbase or ''
 
   if options.v8_options:
-    o['variables']['node_v8_options'] = options.v8_options.replace('"', '\\"')
+    variables['node_v8_options'] = options.v8_options.replace('"', '\\"')
 
   if options.enable_static:
-    o['variables']['node_target_type'] = 'static_library'
+    variables['node_target_type'] = 'static_library'
 
-  o['variables']['node_debug_lib'] = b(options.node_debug_lib)
+  variables['node_debug_lib'] = b(options.node_debug_lib)
 
   if options.debug_nghttp2:
-    o['variables']['debug_nghttp2'] = 1
+    variables['debug_nghttp2'] = 1
   else:
-    o['variables']['debug_nghttp2'] = 'false'
+    variables['debug_nghttp2'] = 'false'
 
-  o['variables']['node_no_browser_globals'] = b(options.no_browser_globals)
+  variables['node_no_browser_globals'] = b(options.no_browser_globals)
   # TODO(refack): fix this when implementing embedded code-cache when cross-compiling.
-  if o['variables']['want_separate_host_toolset'] == 0:
-    o['variables']['node_code_cache_path'] = 'yes'
-  o['variables']['node_shared'] = b(options.shared)
+  if variables['want_separate_host_toolset'] == 0:
+    variables['node_code_cache_path'] = 'yes'
+  variables['node_shared'] = b(options.shared)
   node_module_version = getmoduleversion.get_version()
 
-  if sys.platform == 'darwin':
-    shlib_suffix = '%s.dylib'
-  elif sys.platform.startswith('aix'):
-    shlib_suffix = '%s.a'
-  else:
-    shlib_suffix = 'so.%s'
-
+  shlib_suffix = shlib_suffix_templates.get(host_platform, 'so.%s')
   shlib_suffix %= node_module_version
-  o['variables']['node_module_version'] = int(node_module_version)
-  o['variables']['shlib_suffix'] = shlib_suffix
+  variables['node_module_version'] = int(node_module_version)
+  variables['shlib_suffix'] = shlib_suffix
 
   if options.linked_module:
-    o['variables']['library_files'] = options.linked_module
+    variables['library_files'] = options.linked_module
 
-  o['variables']['asan'] = int(options.enable_asan or 0)
+  variables['asan'] = int(options.enable_asan or 0)
 
   if options.coverage:
-    o['variables']['coverage'] = 'true'
+    variables['coverage'] = 'true'
   else:
-    o['variables']['coverage'] = 'false'
+    variables['coverage'] = 'false'
 
   if options.shared:
-    o['variables']['node_target_type'] = 'shared_library'
+    variables['node_target_type'] = 'shared_library'
   elif options.enable_static:
-    o['variables']['node_target_type'] = 'static_library'
+    variables['node_target_type'] = 'static_library'
   else:
-    o['variables']['node_target_type'] = 'executable'
+    variables['node_target_type'] = 'executable'
 
-def configure_library(lib, output):
+def configure_library(lib, output, variable=None):
   shared_lib = 'shared_' + lib
-  output['variables']['node_' + shared_lib] = b(getattr(options, shared_lib))
-
-  if getattr(options, shared_lib):
-    (pkg_libs, pkg_cflags, pkg_libpath, pkg_modversion) = pkg_config(lib)
-
-    if options.__dict__[shared_lib + '_includes']:
-      output['include_dirs'] += [options.__dict__[shared_lib + '_includes']]
-    elif pkg_cflags:
-      stripped_flags = [flag.strip() for flag in pkg_cflags.split('-I')]
-      output['include_dirs'] += [flag for flag in stripped_flags if flag]
-
-    # libpath needs to be provided ahead libraries
-    if options.__dict__[shared_lib + '_libpath']:
-      if flavor == 'win':
-        if 'msvs_settings' not in output:
-          output['msvs_settings'] = { 'VCLinkerTool': { 'AdditionalOptions': [] } }
-        output['msvs_settings']['VCLinkerTool']['AdditionalOptions'] += [
-          '/LIBPATH:%s' % options.__dict__[shared_lib + '_libpath']]
-      else:
-        output['libraries'] += [
-            '-L%s' % options.__dict__[shared_lib + '_libpath']]
-    elif pkg_libpath:
-      output['libraries'] += [pkg_libpath]
+  use_shared = getattr(options, shared_lib)
+  output['variables'][variable or 'node_' + shared_lib] = b(use_shared)
+
+  if not use_shared:
+    return
+
+  includes = getattr(options, shared_lib + '_includes')
+  libpath = getattr(options, shared_lib + '_libpath')
+  libname = getattr(options, shared_lib + '_libname')
+  (pkg_libs, pkg_cflags, pkg_libpath, pkg_modversion) = pkg_config(lib)
+
+  if includes:
+    output['include_dirs'] += [includes]
+  elif pkg_cflags:
+    stripped_flags = [flag.strip() for flag in pkg_cflags.split('-I')]
+    output['include_dirs'] += [flag for flag in stripped_flags if flag]
+
+  # libpath needs to be provided ahead libraries
+  if libpath:
+    if flavor == 'win':
+      if 'msvs_settings' not in output:
+        output['msvs_settings'] = { 'VCLinkerTool': { 'AdditionalOptions': [] } }
+      output['msvs_settings']['VCLinkerTool']['AdditionalOptions'] += [
+        '/LIBPATH:%s' % libpath]
+    else:
+      output['libraries'] += ['-L%s' % libpath]
+  elif pkg_libpath:
+    output['libraries'] += [pkg_libpath]
 
-    default_libs = getattr(options, shared_lib + '_libname')
-    default_libs = ['-l{0}'.format(l) for l in default_libs.split(',')]
+  default_libs = ['-l%s' % l for l in libname.split(',')]
 
-    if default_libs:
-      output['libraries'] += default_libs
-    elif pkg_libs:
-      output['libraries'] += pkg_libs.split()
+  if default_libs:
+    output['libraries'] += default_libs
+  elif pkg_libs:
+    output['libraries'] += pkg_libs.split()
 
 
 def configure_v8(o):
-  o['variables']['v8_enable_gdbjit'] = 1 if options.gdb else 0
-  o['variables']['v8_no_strict_aliasing'] = 1  # Work around compiler bugs.
-  o['variables']['v8_optimized_debug'] = 0 if options.v8_non_optimized_debug else 1
-  o['variables']['v8_random_seed'] = 0  # Use a random seed for hash tables.
-  o['variables']['v8_promise_internal_field_count'] = 1 # Add internal field to promises for async hooks.
-  o['variables']['v8_use_siphash'] = 0 if options.without_siphash else 1
-  o['variables']['v8_use_snapshot'] = 0 if options.without_snapshot else 1
-  o['variables']['v8_trace_maps'] = 1 if options.trace_maps else 0
-  o['variables']['node_use_v8_platform'] = b(not options.without_v8_platform)
-  o['variables']['node_use_bundled_v8'] = b(not options.without_bundled_v8)
-  o['variables']['force_dynamic_crt'] = 1 if options.shared else 0
-  o['variables']['node_enable_d8'] = b(options.enable_d8)
+  variables = o['variables']
+  variables.update({
+    'v8_enable_gdbjit': 1 if options.gdb else 0,
+    'v8_no_strict_aliasing': 1,  # Work around compiler bugs.
+    'v8_optimized_debug': 0 if options.v8_non_optimized_debug else 1,
+    'v8_random_seed': 0,  # Use a random seed for hash tables.
+    # Add internal field to promises for async hooks.
+    'v8_promise_internal_field_count': 1,
+    'v8_use_siphash': 0 if options.without_siphash else 1,
+    'v8_use_snapshot': 0 if options.without_snapshot else 1,
+    'v8_trace_maps': 1 if options.trace_maps else 0,
+    'node_use_v8_platform': b(not options.without_v8_platform),
+    'node_use_bundled_v8': b(not options.without_bundled_v8),
+    'force_dynamic_crt': 1 if options.shared else 0,
+    'node_enable_d8': b(options.enable_d8),
+  })
   if options.enable_d8:
-    o['variables']['test_isolation_mode'] = 'noop'  # Needed by d8.gyp.
+    variables['test_isolation_mode'] = 'noop'  # Needed by d8.gyp.
   if options.without_bundled_v8 and options.enable_d8:
     raise Exception('--enable-d8 is incompatible with --without-bundled-v8.')
   if options.without_bundled_v8 and options.build_v8_with_gn:
@@ -1163,7 +1351,7 @@ def configure_v8(o):
     v8_path = os.path.join('deps', 'v8')
     print('Fetching dependencies to build V8 with GN')
     options.build_v8_with_gn = FetchDeps(v8_path)
-  o['variables']['build_v8_with_gn'] = b(options.build_v8_with_gn)
+  variables['build_v8_with_gn'] = b(options.build_v8_with_gn)
 
 
 def configure_openssl(o):
@@ -1247,30 +1435,38 @@ def write(filename, data):
 
 do_not_edit = '# Do not edit. Generated by the configure script.\n'
 
+def list_dir(path):
+  """Returns the entries of directory path, or [] if it doesn't exist."""
+  try:
+    return os.listdir(path)
+  except OSError:
+    return []
+
 def glob_to_var(dir_base, dir_sub, patch_dir):
   list = []
   dir_all = '%s/%s' % (dir_base, dir_sub)
-  files = os.walk(dir_all)
-  for ent in files:
-    (path, dirs, files) = ent
-    for file in files:
-      if file.endswith('.cpp') or file.endswith('.c') or file.endswith('.h'):
-        # srcfile uses "slash" as dir separator as its output is consumed by gyp
-        srcfile = '%s/%s' % (dir_sub, file)
-        if patch_dir:
-          patchfile = '%s/%s/%s' % (dir_base, patch_dir, file)
-          if os.path.isfile(patchfile):
-            srcfile = '%s/%s' % (patch_dir, file)
-            info('Using floating patch "%s" from "%s"' % (patchfile, dir_base))
-        list.append(srcfile)
-    break
+  # List the floating patches once instead of probing for one per file.
+  patches = set(list_dir('%s/%s' % (dir_base, patch_dir))) if patch_dir else ()
+  dir_all_prefix = dir_all + '/'
+  # srcfile uses "slash" as dir separator as its output is consumed by gyp
+  src_prefix = dir_sub + '/'
+  for file in list_dir(dir_all):
+    if not file.endswith(('.cpp', '.c', '.h')):
+      continue
+    if os.path.isdir(dir_all_prefix + file):
+      continue
+    srcfile = src_prefix + file
+    if file in patches:
+      patchfile = '%s/%s/%s' % (dir_base, patch_dir, file)
+      if os.path.isfile(patchfile):
+        srcfile = '%s/%s' % (patch_dir, file)
+        info('Using floating patch "%s" from "%s"' % (patchfile, dir_base))
+    list.append(srcfile)
   return list
 
 def configure_intl(o):
-  def icu_download(path):
-    depFile = 'tools/icu/current_ver.dep';
-    with open(depFile) as f:
-      icus = json.load(f)
+  depFile = 'tools/icu/current_ver.dep'
+  def icu_download(icus):
     # download ICU, if needed
     if not os.access(options.download_path, os.W_OK):
       error('''Cannot write to desired download path.
@@ -1292,10 +1488,22 @@ def configure_intl(o):
       else:
         print('Re-using existing %s' % targetfile)
       if os.path.isfile(targetfile):
+        # Hashing the tarball takes a while; remember a successful check
+        # for as long as the file (and the expected hash) stay the same.
+        hashok = targetfile + '.hashok'
+        stamp = '%r %s %s\n' % (file_stamp(targetfile), hashAlgo, expectHash)
+        if os.path.isfile(hashok):
+          with open(hashok) as f:
+            if f.read() == stamp:
+              print('%s:      %s  %s (unchanged)' %
+                    (hashAlgo, expectHash, targetfile))
+              return targetfile
         print('Checking file integrity with %s:\r' % hashAlgo)
         gotHash = nodedownload.checkHash(targetfile, hashAlgo)
         print('%s:      %s  %s' % (hashAlgo, gotHash, targetfile))
         if (expectHash == gotHash):
+          with open(hashok, 'w') as f:
+            f.write(stamp)
           return targetfile
         else:
           warn('Expected: %s      *MISMATCH*' % expectHash)
@@ -1309,8 +1517,7 @@ def configure_intl(o):
     return
 
   # write an empty file to start with
-  write(icu_config_name, do_not_edit +
-        pprint.pformat(icu_config, indent=2) + '\n')
+  write(icu_config_name, do_not_edit + repr(icu_config) + '\n')
 
   # always set icu_small, node.gyp depends on it being defined.
   o['variables']['icu_small'] = b(False)
@@ -1337,7 +1544,7 @@ def configure_intl(o):
     o['variables']['icu_small'] = b(True)
     locs = set(options.with_icu_locales.split(','))
     locs.add('root')  # must have root
-    o['variables']['icu_locales'] = string.join(locs,',')
+    o['variables']['icu_locales'] = ','.join(locs)
     # We will check a bit later if we can use the canned deps/icu-small
   elif with_intl == 'full-icu':
     # full ICU
@@ -1405,7 +1612,7 @@ def configure_intl(o):
 
   # --with-icu-source processing
   # now, check that they didn't pass --with-icu-source=deps/icu
-  elif with_icu_source and os.path.abspath(icu_full_path) == os.path.abspath(with_icu_source):
+  elif with_icu_source and os.path.realpath(icu_full_path) == os.path.realpath(with_icu_source):
     warn('Ignoring redundant --with-icu-source=%s' % with_icu_source)
     with_icu_source = None
   # if with_icu_source is still set, try to use it.
@@ -1450,7 +1657,8 @@ def configure_intl(o):
   o['variables']['icu_path'] = icu_full_path
   if not os.path.isdir(icu_full_path):
     # can we download (or find) a zipfile?
-    localzip = icu_download(icu_full_path)
+    with open(depFile) as f:
+      localzip = icu_download(json.load(f))
     if localzip:
       nodedownload.unpack(localzip, icu_parent_path)
     else:
@@ -1465,13 +1673,10 @@ def configure_intl(o):
   uvernum_h = os.path.join(icu_full_path, 'source/common/unicode/uvernum.h')
   if not os.path.isfile(uvernum_h):
     error('Could not load %s - is ICU installed?' % uvernum_h)
-  icu_ver_major = None
-  matchVerExp = r'^\s*#define\s+U_ICU_VERSION_SHORT\s+"([^"]*)".*'
-  match_version = re.compile(matchVerExp)
-  for line in open(uvernum_h).readlines():
-    m = match_version.match(line)
-    if m:
-      icu_ver_major = m.group(1)
+  with open(uvernum_h) as f:
+    m = re.search(r'^[ \t]*#define[ \t]+U_ICU_VERSION_SHORT[ \t]+"([^"]*)"',
+                  f.read(), re.MULTILINE)
+  icu_ver_major = m.group(1) if m else None
   if not icu_ver_major:
     error('Could not read U_ICU_VERSION_SHORT version from %s' % uvernum_h)
   elif int(icu_ver_major) < icu_versions['minimum_icu']:
@@ -1519,9 +1724,9 @@ def configure_intl(o):
     var  = 'icu_src_%s' % i
     path = '../../%s/source/%s' % (icu_full_path, icu_src[i])
     icu_config['variables'][var] = glob_to_var('tools/icu', path, 'patches/%s/source/%s' % (icu_ver_major, icu_src[i]) )
-  # write updated icu_config.gypi with a bunch of paths
-  write(icu_config_name, do_not_edit +
-        pprint.pformat(icu_config, indent=2) + '\n')
+  # write updated icu_config.gypi with a bunch of paths. Only gyp reads it, so
+  # don't spend time pretty-printing hundreds of file names.
+  write(icu_config_name, do_not_edit + repr(icu_config) + '\n')
   return  # end of configure_intl
 
 def configure_inspector(o):
@@ -1564,6 +1769,62 @@ def make_bin_override():
 
   return bin_override
 
+# Environment variables and files the configure_*() steps read. Together
+# with the options and compilers, they decide whether --config-cache can
+# reuse the output of the previous run.
+config_cache_env = ('CC', 'CXX', 'CC_host', 'PATH', 'PKG_CONFIG',
+                    'PROCESSOR_ARCHITECTURE',
+                    'PROCESSOR_ARCHITEW6432') + pkg_config_env
+config_cache_inputs = ('configure', 'configure.py', 'src/node_version.h',
+                       'tools/icu/current_ver.dep',
+                       'tools/icu/icu_versions.json')
+
+def config_cache_stamp():
+  return json.dumps([sorted(vars(options).items()),
+                     [os.environ.get(var) for var in config_cache_env],
+                     command_stamp(CC), command_stamp(CXX),
+                     command_stamp(os.environ.get('CC_host', '')),
+                     command_stamp(os.environ.get('PKG_CONFIG',
+                                                  'pkg-config')),
+                     [file_stamp(path) for path in config_cache_inputs]])
+
+def read_config_cache(stamp):
+  """Returns the entry saved by write_config_cache(), or None if it was saved
+  under a different stamp or any file it read or generated has changed
+  since."""
+  entry = read_configure_cache('config.json')
+  if not entry or entry['stamp'] != stamp:
+    return None
+  for path, file_stamp_then in entry['files']:
+    if file_stamp(path) != file_stamp_then:
+      return None
+  return entry
+
+def write_config_cache(stamp, output, warnings):
+  # Besides what config_cache_stamp() covers, the output depends on the .pc
+  # files of shared libraries and the ICU sources, and the generated
+  # icu_config.gypi must still be there.
+  variables = output['variables']
+  files = ['icu_config.gypi'] + pkg_config_files
+  icu_path = variables.get('icu_path')
+  if icu_path:
+    files += [icu_path,
+              os.path.join(icu_path, 'source/common/unicode/uvernum.h')]
+    # configure_intl() prefers the little-endian data file, if it exists.
+    icu_data = os.path.join(icu_path, 'source/data/in',
+                            'icudt%s%%s.dat' % variables['icu_ver_major'])
+    files += [icu_data % endianness for endianness in
+              sorted(set(['l', variables['icu_endianness']]))]
+  entry = read_configure_cache('config.json')
+  entry.clear()
+  entry.update({
+    'stamp': stamp,
+    'files': [[path, file_stamp(path)] for path in files],
+    'output': output,
+    'warnings': warnings,
+  })
+  write_configure_cache('config.json')
+
 output = {
   'variables': {},
   'include_dirs': [],
@@ -1572,9 +1833,6 @@ output = {
   'cflags': [],
 }
 
-# Print a warning when the compiler is too old.
-check_compiler(output)
-
 # determine the "flavor" (operating system) we're building for,
 # leveraging gyp's GetFlavor function
 flavor_params = {}
@@ -1582,20 +1840,42 @@ if (options.dest_os):
   flavor_params['flavor'] = options.dest_os
 flavor = GetFlavor(flavor_params)
 
-configure_node(output)
-configure_library('zlib', output)
-configure_library('http_parser', output)
-configure_library('libuv', output)
-configure_library('libcares', output)
-configure_library('nghttp2', output)
-# stay backwards compatible with shared cares builds
-output['variables']['node_shared_cares'] = \
-    output['variables'].pop('node_shared_libcares')
-configure_v8(output)
-configure_openssl(output)
-configure_intl(output)
-configure_static(output)
-configure_inspector(output)
+if options.config_cache and options.with_icu_source:
+  # The ICU sources it points to can change in place without anything
+  # cheap to stamp, so always unpack and configure them again.
+  info('not using --config-cache together with --with-icu-source')
+  options.config_cache = False
+
+config_cache = None
+if options.config_cache:
+  # Stamp the inputs now: configure_v8() replaces options.build_v8_with_gn.
+  config_stamp = config_cache_stamp()
+  config_cache = read_config_cache(config_stamp)
+if config_cache:
+  info('using the configuration cached by the previous --config-cache run')
+  output = config_cache['output']
+  for msg in config_cache['warnings']:
+    warn(msg)
+else:
+  first_warning = len(warn.messages)
+  # Print a warning when the compiler is too old.
+  check_compiler(output)
+
+  configure_node(output)
+  configure_library('zlib', output)
+  configure_library('http_parser', output)
+  configure_library('libuv', output)
+  # stay backwards compatible with shared cares builds
+  configure_library('libcares', output, 'node_shared_cares')
+  configure_library('nghttp2', output)
+  configure_v8(output)
+  configure_openssl(output)
+  configure_intl(output)
+  configure_static(output)
+  configure_inspector(output)
+
+  if options.config_cache:
+    write_config_cache(config_stamp, output, warn.messages[first_warning:])
 
 # variables should be a root level element,
 # move everything else to target_defaults
@@ -1603,6 +1883,13 @@ variables = output['variables']
 del output['variables']
 variables['is_debug'] = B(options.debug)
 
+# Only needed to write the generated files below.
+import pprint
+try:
+  from shlex import quote  # Python 3.3+
+except ImportError:
+  from pipes import quote
+
 # make_global_settings for special FIPS linking
 # should not be used to compile modules in node-gyp
 config_fips = { 'make_global_settings' : [] }
@@ -1632,7 +1919,7 @@ write('config.gypi', do_not_edit +
       pprint.pformat(output, indent=2) + '\n')
 
 write('config.status', '#!/bin/sh\nset -x\nexec ./configure ' +
-      ' '.join([pipes.quote(arg) for arg in original_argv]) + '\n')
+      ' '.join(map(quote, original_argv)) + '\n')
 os.chmod('config.status', 0o775)
 
 